@@ -4,7 +4,8 @@ radiacode2mqtt.py (publisher-only) with robust BLE recovery (NO addrType patch).
 
 Why this version:
 - MQTT connects first so status is always visible even if BLE connect hangs.
-- Optional BLE scan preflight to avoid connect attempts when device isn't advertising.
+- Optional BLE scan preflight to avoid connect attempts when device isn't advertising
+  (a background scanner keeps a recently-seen cache; connect attempts just look it up).
 - Hard connect timeout so bluepy/radiacode connect cannot stall forever.
 - Recovery:
   1) Detect stale realtime stream (no RealTimeData for watchdog_s)
@@ -15,25 +16,34 @@ Why this version:
 
 Topics (base = <topic_prefix>/<device_id>):
 - <base>/state            (NOT retained)
+- <base>/state.bin        (msgpack mirror of state; NOT retained; only when state_encoding=msgpack)
 - <base>/availability     ("online"/"offline"; retained)
 - <base>/status           (JSON status/errors; NOT retained)
-- <base>/heartbeat        (ts only; NOT retained)
 - <base>/raw_fields       (debug snapshot; retained; only when debug enabled)
 - <base>/spectrum         (optional; retain configurable)
 """
 
 from __future__ import annotations
 
+import base64
+import functools
 import json
 import logging
+import operator
+import os
 import signal
 import subprocess
+import struct
 import sys
+import threading
 import time
 import traceback
+import zlib
 from dataclasses import dataclass
-from typing import Any, Optional, Tuple
+from types import MappingProxyType
+from typing import Any, Callable, Optional, Tuple
 
+import orjson
 import paho.mqtt.client as mqtt
 from radiacode import RadiaCode, RealTimeData, RareData
 
@@ -42,22 +52,22 @@ from radiacode import RadiaCode, RealTimeData, RareData
 # Units / scaling
 # ---------------------------
 
-PREFIX_FACTOR = {
+PREFIX_FACTOR = MappingProxyType({
     "whole": 1.0,
     "deci": 10.0,
     "centi": 100.0,
     "milli": 1_000.0,
     "micro": 1_000_000.0,
     "nano": 1_000_000_000.0,
-}
-PREFIX_SYMBOL = {
+})
+PREFIX_SYMBOL = MappingProxyType({
     "whole": "",
     "deci": "d",
     "centi": "c",
     "milli": "m",
     "micro": "µ",
     "nano": "n",
-}
+})
 
 
 # ---------------------------
@@ -104,22 +114,81 @@ def get_system_and_prefix(opts: dict[str, Any]) -> tuple[str, str]:
     return system, prefix
 
 
+@functools.lru_cache(maxsize=None)
+def _units(system: str, prefix: str) -> tuple[str, str, float]:
+    """(rate_unit, dose_unit, factor) for a validated system/prefix pair."""
+    sym = PREFIX_SYMBOL[prefix]
+    return f"{sym}{system}/h", f"{sym}{system}", float(PREFIX_FACTOR[prefix])
+
+
 def get_rate_unit_and_factor(opts: dict[str, Any]) -> Tuple[str, float]:
-    system, prefix = get_system_and_prefix(opts)
-    factor = float(PREFIX_FACTOR[prefix])
-    unit = f"{PREFIX_SYMBOL[prefix]}{system}/h"
+    unit, _, factor = _units(*get_system_and_prefix(opts))
     return unit, factor
 
 
 def get_dose_unit_and_factor(opts: dict[str, Any]) -> Tuple[str, float]:
-    system, prefix = get_system_and_prefix(opts)
-    factor = float(PREFIX_FACTOR[prefix])
-    unit = f"{PREFIX_SYMBOL[prefix]}{system}"
+    _, unit, factor = _units(*get_system_and_prefix(opts))
     return unit, factor
 
 
-def json_dumps(obj: Any) -> str:
-    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+def json_dumps(obj: Any) -> bytes:
+    # Compact UTF-8 bytes; paho publishes bytes as-is, so no decode round-trip.
+    return orjson.dumps(obj)
+
+
+def json_prefix(static: dict[str, Any]) -> bytes:
+    """Pre-encode invariant fields as an open JSON object: b'{"k":v,'."""
+    return orjson.dumps(static)[:-1] + b","
+
+
+def json_splice(prefix: bytes, dynamic: dict[str, Any]) -> bytes:
+    """Join a json_prefix() with the encoding of the per-tick fields."""
+    return prefix + orjson.dumps(dynamic)[1:]
+
+
+# Fields that move every tick without carrying new information
+STATE_VOLATILE_KEYS = frozenset({"ts", "last_seen_ts", "last_seen_age_s", "rare_last_seen_age_s"})
+STATE_REFRESH_MAX_S = 30.0
+
+
+def stable_fields(payload: dict[str, Any], volatile: frozenset[str] = STATE_VOLATILE_KEYS) -> dict[str, Any]:
+    """Payload without its volatile fields, compared with != to skip identical publishes."""
+    return {k: v for k, v in payload.items() if k not in volatile}
+
+
+SPECTRUM_PACKED_ENCODING = "zlib+u32le"
+
+
+def get_spectrum_encoding(spectrum_cfg: dict[str, Any]) -> str:
+    enc = str(spectrum_cfg.get("encoding", "json") or "json").lower()
+    return enc if enc in ("json", "packed") else "json"
+
+
+def pack_counts(counts: list[int]) -> str:
+    """base64(zlib(little-endian uint32 counts)); most bins are small and similar, so zlib shrinks them a lot."""
+    raw = struct.pack(f"<{len(counts)}I", *counts)
+    return base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+
+
+def get_state_encoding(opts: dict[str, Any]) -> str:
+    enc = str(opts.get("state_encoding", "json") or "json").lower()
+    return enc if enc in ("json", "msgpack") else "json"
+
+
+def make_state_packer(encoding: str, log: logging.Logger) -> Optional[Callable[[dict[str, Any]], bytes]]:
+    """Return the binary encoder for the <base>/state.bin mirror, or None for JSON only."""
+    if encoding != "msgpack":
+        return None
+    try:
+        import msgpack  # type: ignore
+    except Exception as e:
+        log.warning("state_encoding=msgpack but msgpack is unavailable (%s); publishing JSON only", e)
+        return None
+
+    def pack(state: dict[str, Any]) -> bytes:
+        return msgpack.packb(state, use_bin_type=True)
+
+    return pack
 
 
 def get_ble_connect_timeout(opts: dict[str, Any]) -> int:
@@ -140,6 +209,80 @@ def get_ble_scan_seconds(opts: dict[str, Any]) -> float:
         return 5.0
 
 
+def get_ble_scan_fresh_seconds(opts: dict[str, Any]) -> float:
+    try:
+        return float(opts.get("ble_scan_fresh_s", 10))
+    except Exception:
+        return 10.0
+
+
+@dataclass(frozen=True, slots=True)
+class RunConfig:
+    """Options resolved once at startup; the poll loop only reads attributes."""
+    debug: bool
+    poll_s: int
+    first_data_timeout_s: float
+    watchdog_s: float
+    status_publish_every_s: float
+
+    dose_system: str
+    dose_prefix: str
+    rate_unit: str
+    rate_factor: float
+    dose_unit: str
+    dose_factor: float
+
+    state_encoding: str
+
+    spectrum_enabled: bool
+    spectrum_interval_s: int
+    spectrum_retain: bool
+    spectrum_encoding: str
+
+    ble_max_recoveries_before_exit: int
+    ble_backoff_s: float
+    ble_backoff_max_s: float
+    ble_scan_enabled: bool
+    ble_scan_s: float
+    ble_scan_fresh_s: float
+    ble_connect_timeout_s: int
+    ble_stall_probes: int
+
+
+def parse_run_cfg(opts: dict[str, Any]) -> RunConfig:
+    spectrum_cfg = (opts.get("spectrum") or {})
+    system, prefix = get_system_and_prefix(opts)
+    rate_unit, rate_factor = get_rate_unit_and_factor(opts)
+    dose_unit, dose_factor = get_dose_unit_and_factor(opts)
+    return RunConfig(
+        debug=bool(opts.get("debug", False)),
+        poll_s=int(opts.get("poll_interval_s", 5)),
+        first_data_timeout_s=float(opts.get("first_data_timeout_s", 60)),
+        watchdog_s=float(opts.get("watchdog_s", 30)),
+        status_publish_every_s=float(opts.get("status_publish_every_s", 30)),
+        dose_system=system,
+        dose_prefix=prefix,
+        rate_unit=rate_unit,
+        rate_factor=rate_factor,
+        dose_unit=dose_unit,
+        dose_factor=dose_factor,
+        state_encoding=get_state_encoding(opts),
+        spectrum_enabled=bool(spectrum_cfg.get("enabled", False)),
+        spectrum_interval_s=int(spectrum_cfg.get("interval_s", 120)),
+        spectrum_retain=bool(spectrum_cfg.get("retain", False)),
+        spectrum_encoding=get_spectrum_encoding(spectrum_cfg),
+        # BLE recovery tuning
+        ble_max_recoveries_before_exit=int(opts.get("ble_max_recoveries_before_exit", 8)),
+        ble_backoff_s=float(opts.get("ble_backoff_s", 2.0)),
+        ble_backoff_max_s=float(opts.get("ble_backoff_max_s", 60.0)),
+        ble_scan_enabled=get_ble_scan_enabled(opts),
+        ble_scan_s=get_ble_scan_seconds(opts),
+        ble_scan_fresh_s=get_ble_scan_fresh_seconds(opts),
+        ble_connect_timeout_s=get_ble_connect_timeout(opts),
+        ble_stall_probes=max(0, int(opts.get("ble_stall_probes", 3))),
+    )
+
+
 # ---------------------------
 # Logging
 # ---------------------------
@@ -167,20 +310,65 @@ def mqtt_make_client(cfg: MqttConfig, client_id: str) -> mqtt.Client:
     return client
 
 
-def mqtt_connect_and_loop(client: mqtt.Client, cfg: MqttConfig, log: logging.Logger, will_topic: str) -> dict[str, Any]:
-    mqtt_state: dict[str, Any] = {"connected": False, "last_connect_ts": None, "last_disconnect_ts": None}
+MQTT_HANDSHAKE_TIMEOUT_S = 10.0
+MQTT_RECONNECT_MIN_DELAY_S = 1
+MQTT_RECONNECT_MAX_DELAY_S = 60
+
+
+def mqtt_connect_and_loop(
+    client: mqtt.Client,
+    cfg: MqttConfig,
+    log: logging.Logger,
+    will_topic: str,
+    on_online: Optional[Callable[[], None]] = None,
+) -> dict[str, Any]:
+    """Connect and complete the handshake, then hand the network loop to the caller.
+
+    paho's background thread is only used until CONNACK (or a short timeout);
+    afterwards the single publishing thread services the socket itself via
+    mqtt_sleep(), so publishes don't contend with a second loop thread.
+
+    on_online runs after every successful CONNACK, including inline
+    reconnects, so availability can be restated after the broker published
+    our will.
+    """
+    mqtt_state: dict[str, Any] = {
+        "connected": False,
+        "last_connect_ts": None,
+        "last_disconnect_ts": None,
+        "next_reconnect_at": 0.0,
+        "reconnect_delay_s": float(MQTT_RECONNECT_MIN_DELAY_S),
+    }
+
+    # Same bounded exponential backoff for paho's own reconnects (handshake
+    # thread) and for ours in mqtt_sleep(); paho errors go to our log.
+    client.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN_DELAY_S, max_delay=MQTT_RECONNECT_MAX_DELAY_S)
+    paho_log = log.getChild("paho")
+    paho_log.setLevel(logging.WARNING)  # errors/warnings only, not per-packet debug
+    client.enable_logger(paho_log)
 
     client.will_set(will_topic, payload="offline", qos=0, retain=True)
 
     def on_connect(_client, _userdata, _flags, reason_code, _props=None):
+        # paho v2 also reports refused CONNACKs (bad credentials, not authorized)
+        # here; those must keep the backoff growing instead of resetting it.
+        if reason_code.is_failure:
+            log.warning("MQTT connection to %s:%s refused (reason_code=%s)", cfg.host, cfg.port, reason_code)
+            return
         mqtt_state["connected"] = True
         mqtt_state["last_connect_ts"] = int(time.time())
+        mqtt_state["reconnect_delay_s"] = float(MQTT_RECONNECT_MIN_DELAY_S)
         log.info("MQTT connected to %s:%s (reason_code=%s)", cfg.host, cfg.port, reason_code)
+        if on_online is not None:
+            try:
+                on_online()
+            except Exception as e:
+                log.error("MQTT on-connect publish failed: %s", e, exc_info=True)
 
-    def on_disconnect(_client, _userdata, reason_code, _props=None):
+    def on_disconnect(_client, _userdata, _flags, reason_code, _props=None):
         mqtt_state["connected"] = False
         mqtt_state["last_disconnect_ts"] = int(time.time())
-        if reason_code == 0:
+        if not reason_code.is_failure:
             log.info("MQTT disconnected cleanly")
         else:
             log.warning("MQTT disconnected (reason_code=%s)", reason_code)
@@ -191,28 +379,67 @@ def mqtt_connect_and_loop(client: mqtt.Client, cfg: MqttConfig, log: logging.Log
     log.info("Connecting to MQTT broker %s:%s", cfg.host, cfg.port)
     client.connect(cfg.host, cfg.port, keepalive=60)
     client.loop_start()
+    deadline = time.monotonic() + MQTT_HANDSHAKE_TIMEOUT_S
+    while not mqtt_state["connected"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    client.loop_stop()
+    if not mqtt_state["connected"]:
+        log.warning("MQTT handshake not completed within %.0fs; continuing and retrying inline", MQTT_HANDSHAKE_TIMEOUT_S)
     return mqtt_state
 
 
+def mqtt_sleep(client: mqtt.Client, mqtt_state: dict[str, Any], log: logging.Logger, seconds: float) -> None:
+    """Wait for `seconds` while running the MQTT network loop on this thread.
+
+    Replaces time.sleep() in the main loop: keepalives, acks and queued
+    writes are handled here, and a lost connection is re-established.
+    """
+    deadline = time.monotonic() + max(0.0, seconds)
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            rc = client.loop(timeout=max(0.0, min(1.0, remaining)))
+        except Exception as e:
+            # A raising callback must not take the poll loop (and a BLE connect
+            # waiting in pump()) down with it; treat it as a lost connection.
+            log.error("MQTT network loop failed: %s", e, exc_info=True)
+            mqtt_state["connected"] = False
+            rc = mqtt.MQTT_ERR_UNKNOWN
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            now = time.monotonic()
+            if now >= mqtt_state["next_reconnect_at"]:
+                delay = mqtt_state["reconnect_delay_s"]
+                mqtt_state["next_reconnect_at"] = now + delay
+                mqtt_state["reconnect_delay_s"] = min(float(MQTT_RECONNECT_MAX_DELAY_S), delay * 2.0)
+                try:
+                    client.reconnect()
+                except Exception as e:
+                    log.warning("MQTT reconnect failed (next attempt in %.0fs): %s", delay, e)
+            # loop() returns immediately while disconnected; don't spin
+            time.sleep(max(0.0, min(1.0, deadline - time.monotonic())))
+        if remaining <= 0:
+            break
+
+
 # ---------------------------
 # HA Discovery
 # ---------------------------
 
-def publish_discovery(client: mqtt.Client, cfg: MqttConfig, opts: dict[str, Any], device_id: str, log: logging.Logger) -> None:
+def build_discovery(cfg: MqttConfig, device_id: str, rate_unit: str, dose_unit: str, expire_after_s: int) -> list[tuple[str, bytes]]:
+    """Return encoded (config_topic, payload) for every sensor; built once at startup."""
     base = f"{cfg.topic_prefix}/{device_id}"
     state_topic = f"{base}/state"
     avail_topic = f"{base}/availability"
 
-    rate_unit, _ = get_rate_unit_and_factor(opts)
-    dose_unit, _ = get_dose_unit_and_factor(opts)
-
     device_block = {
         "identifiers": [device_id],
         "name": "Radiacode",
         "manufacturer": "Radiacode",
     }
 
-    def pub_sensor(
+    items: list[tuple[str, bytes]] = []
+
+    def add_sensor(
         object_id: str,
         name: str,
         value_template: str,
@@ -226,6 +453,8 @@ def publish_discovery(client: mqtt.Client, cfg: MqttConfig, opts: dict[str, Any]
             "value_template": value_template,
             "availability_topic": avail_topic,
             "device": device_block,
+            # state carries ts every poll; HA marks the entity unavailable if it stops
+            "expire_after": expire_after_s,
         }
         if unit is not None:
             payload["unit_of_measurement"] = unit
@@ -233,24 +462,31 @@ def publish_discovery(client: mqtt.Client, cfg: MqttConfig, opts: dict[str, Any]
             payload["device_class"] = device_class
 
         topic = f"{cfg.discovery_prefix}/sensor/{device_id}/{object_id}/config"
-        client.publish(topic, json_dumps(payload), retain=True)
+        items.append((topic, json_dumps(payload)))
+
+    add_sensor("dose_rate", "Radiacode Dose Rate", "{{ value_json.dose_rate }}", rate_unit)
+    add_sensor("cps", "Radiacode CPS", "{{ value_json.cps }}", "cps")
+    add_sensor("count_rate_err", "Radiacode CPS Error", "{{ value_json.count_rate_err }}", "%")
+    add_sensor("dose_rate_err", "Radiacode Dose Rate Error", "{{ value_json.dose_rate_err }}", "%")
+    add_sensor("flags", "Radiacode Flags", "{{ value_json.flags }}")
+    add_sensor("real_time_flags", "Radiacode Real-Time Flags", "{{ value_json.real_time_flags }}")
 
-    pub_sensor("dose_rate", "Radiacode Dose Rate", "{{ value_json.dose_rate }}", rate_unit)
-    pub_sensor("cps", "Radiacode CPS", "{{ value_json.cps }}", "cps")
-    pub_sensor("count_rate_err", "Radiacode CPS Error", "{{ value_json.count_rate_err }}", "%")
-    pub_sensor("dose_rate_err", "Radiacode Dose Rate Error", "{{ value_json.dose_rate_err }}", "%")
-    pub_sensor("flags", "Radiacode Flags", "{{ value_json.flags }}")
-    pub_sensor("real_time_flags", "Radiacode Real-Time Flags", "{{ value_json.real_time_flags }}")
+    add_sensor("temperature_c", "Radiacode Temperature", "{{ value_json.temperature_c }}", "°C", device_class="temperature")
+    add_sensor("battery_pct", "Radiacode Battery", "{{ value_json.battery_pct }}", "%", device_class="battery")
+    add_sensor("spectrum_duration_s", "Radiacode Spectrum Duration", "{{ value_json.spectrum_duration_s }}", "s", device_class="duration")
+    add_sensor("dose_total", "Radiacode Total Dose", "{{ value_json.dose_total }}", dose_unit)
 
-    pub_sensor("temperature_c", "Radiacode Temperature", "{{ value_json.temperature_c }}", "°C", device_class="temperature")
-    pub_sensor("battery_pct", "Radiacode Battery", "{{ value_json.battery_pct }}", "%", device_class="battery")
-    pub_sensor("spectrum_duration_s", "Radiacode Spectrum Duration", "{{ value_json.spectrum_duration_s }}", "s", device_class="duration")
-    pub_sensor("dose_total", "Radiacode Total Dose", "{{ value_json.dose_total }}", dose_unit)
+    add_sensor("last_seen_age_s", "Radiacode Last Seen Age", "{{ value_json.last_seen_age_s }}", "s", device_class="duration")
+    add_sensor("device_status", "Radiacode Device Status", "{{ value_json.device_status }}")
+    add_sensor("mqtt_connected", "Radiacode MQTT Connected", "{{ value_json.mqtt_connected }}")
 
-    pub_sensor("last_seen_age_s", "Radiacode Last Seen Age", "{{ value_json.last_seen_age_s }}", "s", device_class="duration")
-    pub_sensor("device_status", "Radiacode Device Status", "{{ value_json.device_status }}")
-    pub_sensor("mqtt_connected", "Radiacode MQTT Connected", "{{ value_json.mqtt_connected }}")
+    return items
 
+
+def publish_discovery(client: mqtt.Client, items: list[tuple[str, bytes]], device_id: str, log: logging.Logger) -> None:
+    """Publish the prebuilt retained discovery configs."""
+    for topic, payload in items:
+        client.publish(topic, payload, qos=0, retain=True)
     log.info("Published MQTT Discovery entities (device_id=%s)", device_id)
 
 
@@ -269,76 +505,235 @@ def safe_close_device(dev: Any, log: logging.Logger) -> None:
                 log.debug("device.%s() failed: %s", name, e)
 
 
+def _find_pids_by_cmdline(needle: bytes) -> Optional[list[int]]:
+    """PIDs whose /proc/<pid>/cmdline contains needle, or None if /proc is unusable."""
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+    me = os.getpid()
+    pids: list[int] = []
+    for name in entries:
+        if not name.isdigit() or int(name) == me:
+            continue
+        try:
+            with open(f"/proc/{name}/cmdline", "rb") as f:
+                if needle in f.read():
+                    pids.append(int(name))
+        except OSError:
+            continue  # exited meanwhile / not ours
+    return pids
+
+
 def kill_bluepy_helper(log: logging.Logger) -> None:
     """Best-effort kill of bluepy-helper processes in the container."""
-    try:
-        res = subprocess.run(["pkill", "-f", "bluepy-helper"], capture_output=True, text=True)
-        if res.returncode == 0:
-            log.warning("Killed bluepy-helper via pkill -f bluepy-helper")
-    except Exception:
-        pass
+    pids = _find_pids_by_cmdline(b"bluepy-helper")
+    if pids is not None:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                log.warning("Killed bluepy-helper (pid=%s)", pid)
+            except OSError:
+                pass
+        return
 
-    try:
-        res = subprocess.run(["killall", "bluepy-helper"], capture_output=True, text=True)
-        if res.returncode == 0:
-            log.warning("Killed bluepy-helper via killall bluepy-helper")
-    except Exception:
-        pass
+    # No /proc: fall back to the external tools, without pipes and with a cap
+    # in case the process table itself is wedged.
+    for cmd in (["pkill", "-f", "bluepy-helper"], ["killall", "bluepy-helper"]):
+        try:
+            res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=2, check=False)
+            if res.returncode == 0:
+                log.warning("Killed bluepy-helper via %s", " ".join(cmd))
+        except Exception:
+            pass
 
 
 class _ConnectTimeout(Exception):
     pass
 
 
-def _alarm_handler(_signum, _frame):
-    raise _ConnectTimeout("connect timeout")
+# Repeats of the same main-loop error within this window are logged without a traceback
+ERROR_TRACEBACK_WINDOW_S = 60.0
 
+# Budget for the serial-number probe sent to a BLE link whose stream stalled
+BLE_LINK_PROBE_TIMEOUT_S = 2.0
 
-def compute_device_id_from_opts(opts: dict[str, Any]) -> tuple[str, str]:
-    mac = (opts.get("radiacode_mac") or "").strip()
-    if mac:
-        return mac.lower().replace(":", ""), "ble"
-    return "radiacode_usb", "usb"
 
+def call_with_timeout(
+    fn: Callable[[], Any],
+    timeout_s: float,
+    name: str,
+    wait: Optional[Callable[[float], None]] = None,
+) -> Any:
+    """Run fn() in a daemon thread and wait at most timeout_s for it.
 
-def ble_scan_for_mac(target_mac: str, scan_s: float, log: logging.Logger) -> bool:
-    """Return True if target_mac is seen during scan window."""
-    try:
-        from bluepy.btle import Scanner  # type: ignore
-        target = target_mac.strip().lower()
-        log.debug("BLE scan preflight: scanning %.1fs for %s", scan_s, target)
-        devs = Scanner().scan(scan_s)
-        for d in devs:
-            if d.addr.lower() == target:
-                log.info("BLE scan preflight: saw target %s (rssi=%s)", d.addr, d.rssi)
-                return True
-        log.warning("BLE scan preflight: did NOT see target %s", target)
-        return False
-    except Exception as e:
-        log.warning("BLE scan preflight failed: %s", e, exc_info=True)
+    Raises TimeoutError if fn() has not returned in time; the worker is left
+    to die on its own (e.g. once the bluepy helper is killed). Exceptions from
+    fn() are re-raised in the caller. With wait, the caller waits in short
+    wait(seconds) slices instead of a bare join, e.g. to keep MQTT serviced.
+    """
+    result: dict[str, Any] = {}
+
+    def runner() -> None:
+        try:
+            result["value"] = fn()
+        except BaseException as e:  # re-raised in the calling thread
+            result["error"] = e
+
+    t = threading.Thread(target=runner, name=name, daemon=True)
+    t.start()
+    if wait is None:
+        t.join(timeout_s)
+    else:
+        deadline = time.monotonic() + timeout_s
+        while t.is_alive():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait(min(0.25, remaining))
+    if t.is_alive():
+        raise TimeoutError(f"{name} did not finish within {timeout_s}s")
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def compute_device_identity(opts: dict[str, Any]) -> tuple[str, str, str, str]:
+    """Normalize radiacode_mac once: (mac_raw, mac_norm, device_id, mode).
+
+    mac_raw is what bluepy connects to, mac_norm (lowercase) is compared with
+    scan results, device_id is the colon-less MAC or "radiacode_usb".
+    """
+    mac_raw = (opts.get("radiacode_mac") or "").strip()
+    if mac_raw:
+        mac_norm = mac_raw.lower()
+        return mac_raw, mac_norm, mac_norm.replace(":", ""), "ble"
+    return "", "", "radiacode_usb", "usb"
+
+
+class BleScanCache:
+    """Background bluepy scanner remembering when each address was last heard.
+
+    Runs in a daemon thread so connect attempts only do a dict lookup instead
+    of blocking for a scan window. BlueZ can't scan and connect at the same
+    time, so callers pause() it around connects and stop() it once connected.
+    """
+
+    def __init__(self, log: logging.Logger) -> None:
+        self._log = log
+        self._lock = threading.Lock()
+        self._seen: dict[str, tuple[int, float]] = {}  # mac -> (rssi, monotonic ts)
+        self._run = threading.Event()
+        self._idle = threading.Event()
+        self._stopped = threading.Event()
+        self._idle.set()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._run.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="ble-scan", daemon=True)
+            self._thread.start()
+
+    def pause(self, timeout_s: float = 3.0) -> None:
+        """Stop scanning and wait (bounded) until the scanner released the adapter."""
+        self._run.clear()
+        self._idle.wait(timeout_s)
+
+    def resume(self) -> None:
+        self._run.set()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.pause()
+
+    def last_seen(self, mac: str) -> Optional[tuple[int, float]]:
+        """(rssi, age_s) of the last advertisement from mac, or None if never heard."""
+        with self._lock:
+            entry = self._seen.get(mac)
+        if entry is None:
+            return None
+        return entry[0], time.monotonic() - entry[1]
+
+    def _record(self, mac: str, rssi: int) -> None:
+        with self._lock:
+            self._seen[mac] = (rssi, time.monotonic())
+
+    def _loop(self) -> None:
+        try:
+            from bluepy.btle import DefaultDelegate, Scanner  # type: ignore
+        except Exception as e:
+            self._log.warning("BLE background scan unavailable: %s", e)
+            return
+
+        cache = self
+
+        class _Delegate(DefaultDelegate):
+            def handleDiscovery(self, dev, _is_new_dev, _is_new_data):
+                cache._record(dev.addr.lower(), dev.rssi)
+
+        while not self._stopped.is_set():
+            if not self._run.wait(0.5):
+                continue
+            # Mark busy before re-checking so a concurrent pause() can't miss us
+            self._idle.clear()
+            if not self._run.is_set() or self._stopped.is_set():
+                self._idle.set()
+                continue
+            try:
+                scanner = Scanner().withDelegate(_Delegate())
+                scanner.start(passive=True)
+                try:
+                    while self._run.is_set() and not self._stopped.is_set():
+                        scanner.process(timeout=1.0)
+                finally:
+                    try:
+                        scanner.stop()
+                    except Exception:
+                        pass
+            except Exception as e:
+                # Helper killed by a recovery / adapter busy: retry shortly
+                self._log.debug("BLE background scan error (restarting): %s", e)
+                self._idle.set()
+                self._stopped.wait(2.0)
+            finally:
+                self._idle.set()
+
+
+def ble_scan_for_mac(scanner: BleScanCache, target: str, fresh_s: float, log: logging.Logger) -> bool:
+    """Return True if target (normalized MAC) was heard within the last fresh_s seconds."""
+    seen = scanner.last_seen(target)
+    if seen is None or seen[1] > fresh_s:
         return False
+    log.info("BLE scan preflight: saw target %s (rssi=%s, %.1fs ago)", target, seen[0], seen[1])
+    return True
 
 
-def make_device(opts: dict[str, Any], log: logging.Logger) -> tuple[RadiaCode, str, str]:
-    mac = (opts.get("radiacode_mac") or "").strip()
+def make_device(
+    mac: str,
+    timeout_s: int,
+    log: logging.Logger,
+    wait: Optional[Callable[[float], None]] = None,
+) -> RadiaCode:
+    """Connect via BLE when mac is set (bounded by timeout_s), else via USB.
 
+    wait is forwarded to call_with_timeout() so the caller can keep MQTT
+    alive while a BLE connect blocks.
+    """
     if mac:
-        timeout_s = get_ble_connect_timeout(opts)
         log.info("Connecting to Radiacode via BLE (mac=%s timeout=%ss)", mac, timeout_s)
 
-        old_handler = signal.signal(signal.SIGALRM, _alarm_handler)
-        signal.alarm(timeout_s)
         try:
-            dev = RadiaCode(bluetooth_mac=mac)
-        finally:
-            signal.alarm(0)
-            signal.signal(signal.SIGALRM, old_handler)
+            dev = call_with_timeout(lambda: RadiaCode(bluetooth_mac=mac), timeout_s, "ble-connect", wait)
+        except TimeoutError as e:
+            # Unblocks the stuck connect thread and frees the adapter
+            kill_bluepy_helper(log)
+            raise _ConnectTimeout("connect timeout") from e
 
-        return dev, mac.lower().replace(":", ""), "ble"
+        return dev
 
     log.info("Connecting to Radiacode via USB (auto-detect)")
-    dev = RadiaCode()
-    return dev, "radiacode_usb", "usb"
+    return RadiaCode()
 
 
 def pick_first(*vals):
@@ -348,18 +743,34 @@ def pick_first(*vals):
     return None
 
 
-def get_latest_records(device: RadiaCode) -> tuple[Optional[RealTimeData], Optional[RareData], dict[str, int]]:
+# RareData is a plain dataclass, so all fields can be read in one C-level call
+_RARE_GET = operator.attrgetter("temperature", "charge_level", "duration", "dose")
+
+
+def get_latest_records(device: RadiaCode, want_hist: bool = False) -> tuple[Optional[RealTimeData], Optional[RareData], dict[str, int]]:
+    """Return the newest RealTimeData/RareData in the buffer.
+
+    Scans from the end and stops once both are found. The record type
+    histogram is only built when asked for (debug) or when no RealTimeData
+    was found, since that is the only case that logs/publishes it otherwise.
+    """
     buf = device.data_buf()
     rt: Optional[RealTimeData] = None
     rare: Optional[RareData] = None
-    types: dict[str, int] = {}
-    for rec in buf:
-        t = type(rec).__name__
-        types[t] = types.get(t, 0) + 1
-        if isinstance(rec, RealTimeData):
+    for rec in reversed(buf):
+        tp = type(rec)
+        if rt is None and tp is RealTimeData:
             rt = rec
-        elif isinstance(rec, RareData):
+        elif rare is None and tp is RareData:
             rare = rec
+        if rt is not None and rare is not None:
+            break
+
+    types: dict[str, int] = {}
+    if want_hist or rt is None:
+        for rec in buf:
+            t = type(rec).__name__
+            types[t] = types.get(t, 0) + 1
     return rt, rare, types
 
 
@@ -369,91 +780,104 @@ def get_latest_records(device: RadiaCode) -> tuple[Optional[RealTimeData], Optio
 
 def main() -> None:
     opts = load_options()
-    debug = bool(opts.get("debug", False))
-    log = setup_logging(debug)
+    # Everything option-derived (incl. units) is fixed for the process lifetime
+    run = parse_run_cfg(opts)
+    log = setup_logging(run.debug)
     cfg = parse_mqtt_cfg(opts)
 
-    poll_s = int(opts.get("poll_interval_s", 5))
-    first_data_timeout_s = float(opts.get("first_data_timeout_s", 60))
-    watchdog_s = float(opts.get("watchdog_s", 30))
-    status_publish_every_s = float(opts.get("status_publish_every_s", 30))
-
-    spectrum_cfg = (opts.get("spectrum") or {})
-    spectrum_enabled = bool(spectrum_cfg.get("enabled", False))
-    spectrum_interval_s = int(spectrum_cfg.get("interval_s", 120))
-    spectrum_retain = bool(spectrum_cfg.get("retain", False))
-
-    # BLE recovery tuning
-    ble_max_recoveries_before_exit = int(opts.get("ble_max_recoveries_before_exit", 8))
-    ble_backoff_s = float(opts.get("ble_backoff_s", 2.0))
-    ble_backoff_max_s = float(opts.get("ble_backoff_max_s", 60.0))
-
-    ble_scan_enabled = get_ble_scan_enabled(opts)
-    ble_scan_s = get_ble_scan_seconds(opts)
-    ble_connect_timeout_s = get_ble_connect_timeout(opts)
-
-    system, prefix = get_system_and_prefix(opts)
-    rate_unit, _ = get_rate_unit_and_factor(opts)
-    dose_unit, _ = get_dose_unit_and_factor(opts)
+    state_pack = make_state_packer(run.state_encoding, log)
 
     log.info("Starting radiacode2mqtt (publisher-only)")
-    log.info("Config: poll_interval_s=%s first_data_timeout_s=%s watchdog_s=%s debug=%s", poll_s, first_data_timeout_s, watchdog_s, debug)
-    log.info("Dose config: system=%s prefix=%s (rate_unit=%s dose_unit=%s)", system, prefix, rate_unit, dose_unit)
-    log.info("Spectrum: enabled=%s interval_s=%s retain=%s", spectrum_enabled, spectrum_interval_s, spectrum_retain)
+    log.info("Config: poll_interval_s=%s first_data_timeout_s=%s watchdog_s=%s debug=%s", run.poll_s, run.first_data_timeout_s, run.watchdog_s, run.debug)
+    log.info("Dose config: system=%s prefix=%s (rate_unit=%s dose_unit=%s)", run.dose_system, run.dose_prefix, run.rate_unit, run.dose_unit)
+    log.info("State encoding: %s", run.state_encoding)
+    log.info("Spectrum: enabled=%s interval_s=%s retain=%s encoding=%s",
+             run.spectrum_enabled, run.spectrum_interval_s, run.spectrum_retain, run.spectrum_encoding)
     log.info("MQTT: host=%s port=%s topic_prefix=%s discovery_prefix=%s discovery=%s",
              cfg.host, cfg.port, cfg.topic_prefix, cfg.discovery_prefix, cfg.discovery)
-    log.info("BLE: scan_enabled=%s scan_seconds=%s connect_timeout_s=%s",
-             ble_scan_enabled, ble_scan_s, ble_connect_timeout_s)
+    log.info("BLE: scan_enabled=%s scan_seconds=%s scan_fresh_s=%s connect_timeout_s=%s",
+             run.ble_scan_enabled, run.ble_scan_s, run.ble_scan_fresh_s, run.ble_connect_timeout_s)
     log.info("BLE recovery: max_recoveries_before_exit=%s backoff_s=%s backoff_max_s=%s",
-             ble_max_recoveries_before_exit, ble_backoff_s, ble_backoff_max_s)
+             run.ble_max_recoveries_before_exit, run.ble_backoff_s, run.ble_backoff_max_s)
 
     # Compute device_id without connecting so MQTT is always available
-    device_id, mode_guess = compute_device_id_from_opts(opts)
+    mac_raw, mac_norm, device_id, mode_guess = compute_device_identity(opts)
 
+    # Topics are built once and interned; every publish reuses the same objects
     base = f"{cfg.topic_prefix}/{device_id}"
-    state_topic = f"{base}/state"
-    status_topic = f"{base}/status"
-    avail_topic = f"{base}/availability"
-    heartbeat_topic = f"{base}/heartbeat"
-    raw_fields_topic = f"{base}/raw_fields"
-    spectrum_topic = f"{base}/spectrum"
+    state_topic = sys.intern(f"{base}/state")
+    state_bin_topic = sys.intern(f"{base}/state.bin")
+    status_topic = sys.intern(f"{base}/status")
+    avail_topic = sys.intern(f"{base}/availability")
+    raw_fields_topic = sys.intern(f"{base}/raw_fields")
+    spectrum_topic = sys.intern(f"{base}/spectrum")
 
     # MQTT connect first
     mqttc = mqtt_make_client(cfg, client_id=f"radiacode2mqtt-{device_id}")
-    mqtt_state = mqtt_connect_and_loop(mqttc, cfg, log, will_topic=avail_topic)
 
-    if cfg.discovery:
-        try:
-            publish_discovery(mqttc, cfg, opts, device_id, log)
-        except Exception as e:
-            log.error("Failed to publish MQTT discovery: %s", e, exc_info=True)
+    # Discovery payloads only depend on startup config. They are retained, so
+    # they survive our session dropping and are sent once, on the first CONNACK.
+    discovery_items = (
+        build_discovery(cfg, device_id, run.rate_unit, run.dose_unit, int(max(run.watchdog_s, run.poll_s) * 2))
+        if cfg.discovery else []
+    )
+    discovery_published = False
 
-    mqttc.publish(avail_topic, "online", retain=True)
-    mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "started", "mode_guess": mode_guess}), retain=False)
+    def on_mqtt_online() -> None:
+        nonlocal discovery_published
+        if cfg.discovery and not discovery_published:
+            try:
+                publish_discovery(mqttc, discovery_items, device_id, log)
+                discovery_published = True
+            except Exception as e:
+                log.error("Failed to publish MQTT discovery: %s", e, exc_info=True)
+        # Every CONNACK: after a dropped session the broker has published our
+        # "offline" will, so restate availability.
+        mqttc.publish(avail_topic, "online", qos=0, retain=True)
+
+    mqtt_state = mqtt_connect_and_loop(mqttc, cfg, log, will_topic=avail_topic, on_online=on_mqtt_online)
+
+    def pump(seconds: float) -> None:
+        mqtt_sleep(mqttc, mqtt_state, log, seconds)
+
+    mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "started", "mode_guess": mode_guess}), qos=0, retain=False)
 
     # Connect device with retry/backoff
     device: Optional[RadiaCode] = None
     device_mode: str = mode_guess
 
     connect_attempt = 0
-    connect_backoff = ble_backoff_s
+    connect_backoff = run.ble_backoff_s
+
+    ble_scanner: Optional[BleScanCache] = None
+    if mode_guess == "ble" and run.ble_scan_enabled:
+        ble_scanner = BleScanCache(log)
+        ble_scanner.start()
 
     while device is None:
         connect_attempt += 1
-        mac = (opts.get("radiacode_mac") or "").strip()
 
-        if mode_guess == "ble" and ble_scan_enabled and mac:
-            seen = ble_scan_for_mac(mac, ble_scan_s, log)
+        if ble_scanner is not None:
+            ble_scanner.resume()
+            # Give the scanner up to ble_scan_seconds to hear the device, returning
+            # as soon as it has; MQTT keeps being serviced meanwhile.
+            scan_deadline = time.monotonic() + run.ble_scan_s
+            seen = ble_scan_for_mac(ble_scanner, mac_norm, run.ble_scan_fresh_s, log)
+            while not seen and time.monotonic() < scan_deadline:
+                mqtt_sleep(mqttc, mqtt_state, log, 0.5)
+                seen = ble_scan_for_mac(ble_scanner, mac_norm, run.ble_scan_fresh_s, log)
+            if not seen:
+                log.warning("BLE scan preflight: did NOT see target %s", mac_norm)
             mqttc.publish(status_topic, json_dumps({
                 "ts": int(time.time()),
                 "status": "ble_scan",
                 "attempt": connect_attempt,
-                "target_mac": mac.lower(),
+                "target_mac": mac_norm,
                 "seen": seen,
-            }), retain=False)
+            }), qos=0, retain=False)
             if not seen:
-                time.sleep(connect_backoff)
-                connect_backoff = min(ble_backoff_max_s, connect_backoff * 2.0)
+                mqtt_sleep(mqttc, mqtt_state, log, connect_backoff)
+                connect_backoff = min(run.ble_backoff_max_s, connect_backoff * 2.0)
                 continue
 
         try:
@@ -462,16 +886,17 @@ def main() -> None:
                 "status": "connecting_device",
                 "attempt": connect_attempt,
                 "mode_guess": mode_guess,
-            }), retain=False)
+            }), qos=0, retain=False)
 
-            device, _device_id2, device_mode = make_device(opts, log)
-            mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "device_connected", "mode": device_mode}), retain=False)
+            if ble_scanner is not None:
+                ble_scanner.pause()
+            device = make_device(mac_raw, run.ble_connect_timeout_s, log, wait=pump)
+            mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "device_connected", "mode": device_mode}), qos=0, retain=False)
             break
 
         except _ConnectTimeout as e:
             log.error("Device connect timed out: %s", e)
-            mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "device_connect_timeout", "error": str(e)}), retain=False)
-            kill_bluepy_helper(log)
+            mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "device_connect_timeout", "error": str(e)}), qos=0, retain=False)
 
         except Exception as e:
             log.error("Device connect failed: %s", e, exc_info=True)
@@ -480,25 +905,30 @@ def main() -> None:
                 "status": "device_connect_failed",
                 "error": str(e),
                 "traceback_tail": traceback.format_exc().splitlines()[-10:],
-            }), retain=False)
+            }), qos=0, retain=False)
             kill_bluepy_helper(log)
 
         if mode_guess == "ble":
-            time.sleep(connect_backoff)
-            connect_backoff = min(ble_backoff_max_s, connect_backoff * 2.0)
-            if connect_attempt >= ble_max_recoveries_before_exit:
-                mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "exiting_for_restart", "attempts": connect_attempt}), retain=False)
-                time.sleep(1.0)
+            mqtt_sleep(mqttc, mqtt_state, log, connect_backoff)
+            connect_backoff = min(run.ble_backoff_max_s, connect_backoff * 2.0)
+            if connect_attempt >= run.ble_max_recoveries_before_exit:
+                mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "exiting_for_restart", "attempts": connect_attempt}), qos=0, retain=False)
+                mqtt_sleep(mqttc, mqtt_state, log, 1.0)
                 raise SystemExit(1)
         else:
-            time.sleep(3)
+            mqtt_sleep(mqttc, mqtt_state, log, 3)
 
     assert device is not None
+    if ble_scanner is not None:
+        ble_scanner.stop()
 
     # Tracking
-    first_data_deadline = time.time() + first_data_timeout_s
+    # Deadlines and ages use the monotonic clock so NTP steps or suspend/resume
+    # can't trigger or stall recoveries; wall time is only used for payload ts.
+    first_data_deadline = time.monotonic() + run.first_data_timeout_s
     last_seen_ts: Optional[float] = None
-    last_status_publish_ts: float = 0.0
+    last_seen_wall: Optional[int] = None
+    last_status_publish_ts: float = float("-inf")
     logged_waiting = False
     device_status = "waiting"
     last_error: Optional[str] = None
@@ -509,35 +939,85 @@ def main() -> None:
     cached_dose_total: Optional[float] = None
     cached_rare_seen_ts: Optional[float] = None
 
-    next_spectrum_at = time.time() + 3.0
+    next_spectrum_at = time.monotonic() + 3.0
+
+    # Unchanged cached/debug payloads are re-sent at least this often so HA's
+    # expire_after never trips. Live readings change every tick and are not deduped.
+    state_refresh_s = min(STATE_REFRESH_MAX_S, max(run.watchdog_s, run.poll_s))
+    last_state_stable: Optional[dict[str, Any]] = None
+    last_state_publish_ts: float = float("-inf")
+    last_raw_stable: Optional[dict[str, Any]] = None
+    last_raw_publish_ts: float = float("-inf")
+
+    last_err_key: Optional[tuple[str, str]] = None
+    last_err_fmt_ts: float = float("-inf")
+    last_err_repeats = 0
 
     ble_recoveries = 0
     ble_next_allowed_reconnect_ts: float = 0.0
-    current_backoff_s = ble_backoff_s
+    ble_stall_probes = 0
+    ble_stall_probe_ts: float = 0.0
+    current_backoff_s = run.ble_backoff_s
+
+    # Invariant fields are encoded once; both state branches splice them in
+    state_static = {"device_mode": device_mode, "dose_total_unit": run.dose_unit}
+    state_prefix = json_prefix(state_static)
 
     log.info("Publishing topics base=%s (device_mode=%s)", base, device_mode)
 
     while True:
-        now = time.time()
-        mqttc.publish(heartbeat_topic, json_dumps({"ts": int(now)}), retain=False)
+        now = time.monotonic()
+        wall = int(time.time())
 
         # BLE watchdog recovery
-        if device_mode == "ble" and last_seen_ts is not None and (now - last_seen_ts) >= watchdog_s:
+        if device_mode == "ble" and last_seen_ts is not None and (now - max(last_seen_ts, ble_stall_probe_ts)) >= run.watchdog_s:
             stale_for = now - last_seen_ts
 
             if now < ble_next_allowed_reconnect_ts:
-                time.sleep(min(poll_s, max(0.1, ble_next_allowed_reconnect_ts - now)))
+                mqtt_sleep(mqttc, mqtt_state, log, min(run.poll_s, max(0.1, ble_next_allowed_reconnect_ts - now)))
                 continue
 
+            # Zombie check: if the device still answers a cheap command the radio
+            # link is fine and only the stream stalled; tearing down would just
+            # cost a reconnect cycle. Each probe buys another watchdog_s, so a
+            # stall is torn down after up to (ble_stall_probes + 1) * watchdog_s.
+            probe_hung = False
+            if ble_stall_probes < run.ble_stall_probes:
+                try:
+                    call_with_timeout(device.serial_number, BLE_LINK_PROBE_TIMEOUT_S, "ble-probe")
+                except TimeoutError as e:
+                    # The probe worker is still blocked inside bluepy
+                    probe_hung = True
+                    log.warning("BLE link probe failed: %s", e)
+                except Exception as e:
+                    log.warning("BLE link probe failed: %s", e)
+                else:
+                    ble_stall_probes += 1
+                    ble_stall_probe_ts = now
+                    log.warning("BLE stream stalled for %.1fs but link responds; keeping connection (%s/%s)",
+                                stale_for, ble_stall_probes, run.ble_stall_probes)
+                    mqttc.publish(status_topic, json_dumps({
+                        "ts": wall,
+                        "status": "ble_stream_stalled",
+                        "stale_for_s": stale_for,
+                        "probe": ble_stall_probes,
+                    }), qos=0, retain=False)
+                    mqtt_sleep(mqttc, mqtt_state, log, run.poll_s)
+                    continue
+
             ble_recoveries += 1
-            log.warning("BLE stale for %.1fs -> recovery attempt %s/%s", stale_for, ble_recoveries, ble_max_recoveries_before_exit)
+            log.warning("BLE stale for %.1fs -> recovery attempt %s/%s", stale_for, ble_recoveries, run.ble_max_recoveries_before_exit)
             mqttc.publish(status_topic, json_dumps({
-                "ts": int(now),
+                "ts": wall,
                 "status": "ble_stale",
                 "stale_for_s": stale_for,
                 "recovery_attempt": ble_recoveries,
                 "backoff_s": current_backoff_s,
-            }), retain=False)
+            }), qos=0, retain=False)
+
+            if probe_hung:
+                # Free the helper the stuck probe holds so close() can't hang on it
+                kill_bluepy_helper(log)
 
             try:
                 safe_close_device(device, log)
@@ -545,40 +1025,45 @@ def main() -> None:
                 pass
 
             kill_bluepy_helper(log)
-            time.sleep(1.5)
+            mqtt_sleep(mqttc, mqtt_state, log, 1.5)
 
             try:
-                device, _did, device_mode = make_device(opts, log)
+                device = make_device(mac_raw, run.ble_connect_timeout_s, log, wait=pump)
+                last_seen_wall = None
                 last_seen_ts = None
                 logged_waiting = False
                 device_status = "waiting"
                 last_error = None
 
-                current_backoff_s = ble_backoff_s
-                ble_next_allowed_reconnect_ts = time.time() + 0.5
+                current_backoff_s = run.ble_backoff_s
+                ble_next_allowed_reconnect_ts = time.monotonic() + 0.5
+                ble_stall_probes = 0
 
                 log.warning("BLE recovery succeeded")
-                mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "ble_recovered", "attempt": ble_recoveries}), retain=False)
+                mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "ble_recovered", "attempt": ble_recoveries}), qos=0, retain=False)
 
             except Exception as e:
                 last_error = str(e)
                 device_status = "error"
                 log.error("BLE recovery failed: %s", e, exc_info=True)
-                mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "ble_recovery_failed", "error": last_error}), retain=False)
+                mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "ble_recovery_failed", "error": last_error}), qos=0, retain=False)
 
-                current_backoff_s = min(ble_backoff_max_s, current_backoff_s * 2.0)
-                ble_next_allowed_reconnect_ts = time.time() + current_backoff_s
+                current_backoff_s = min(run.ble_backoff_max_s, current_backoff_s * 2.0)
+                ble_next_allowed_reconnect_ts = time.monotonic() + current_backoff_s
+                # The old device is closed and its helper killed; later passes
+                # must go straight to reconnecting instead of probing it.
+                ble_stall_probes = run.ble_stall_probes
 
-                if ble_recoveries >= ble_max_recoveries_before_exit:
-                    mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "exiting_for_restart", "recovery_attempts": ble_recoveries}), retain=False)
-                    time.sleep(1.0)
+                if ble_recoveries >= run.ble_max_recoveries_before_exit:
+                    mqttc.publish(status_topic, json_dumps({"ts": int(time.time()), "status": "exiting_for_restart", "recovery_attempts": ble_recoveries}), qos=0, retain=False)
+                    mqtt_sleep(mqttc, mqtt_state, log, 1.0)
                     raise SystemExit(1)
 
-            time.sleep(0.5)
+            mqtt_sleep(mqttc, mqtt_state, log, 0.5)
             continue
 
         # Spectrum
-        if spectrum_enabled and now >= next_spectrum_at:
+        if run.spectrum_enabled and now >= next_spectrum_at:
             try:
                 spec = device.spectrum()
                 payload = {
@@ -587,56 +1072,70 @@ def main() -> None:
                     "a0": getattr(spec, "a0", None),
                     "a1": getattr(spec, "a1", None),
                     "a2": getattr(spec, "a2", None),
-                    "counts": getattr(spec, "counts", None),
                 }
-                mqttc.publish(spectrum_topic, json_dumps(payload), qos=0, retain=spectrum_retain)
+                counts = getattr(spec, "counts", None)
+                if run.spectrum_encoding == "packed" and counts is not None:
+                    payload["channels"] = len(counts)
+                    payload["counts_encoding"] = SPECTRUM_PACKED_ENCODING
+                    payload["counts_b64"] = pack_counts(counts)
+                else:
+                    payload["counts"] = counts
+                mqttc.publish(spectrum_topic, json_dumps(payload), qos=0, retain=run.spectrum_retain)
             except Exception as e:
                 log.debug("Spectrum read failed (ignored): %s", e)
-            next_spectrum_at = now + max(5, spectrum_interval_s)
+            next_spectrum_at = now + max(5, run.spectrum_interval_s)
 
         try:
-            rt, rare, type_hist = get_latest_records(device)
+            rt, rare, type_hist = get_latest_records(device, want_hist=run.debug)
 
             if rt is None:
                 if last_seen_ts is None:
                     device_status = "waiting" if now < first_data_deadline else "stale"
                 else:
-                    device_status = "stale" if (now - last_seen_ts) >= watchdog_s else "waiting"
+                    device_status = "stale" if (now - last_seen_ts) >= run.watchdog_s else "waiting"
 
                 if not logged_waiting:
                     log.warning("No RealTimeData (status=%s) buf_types=%s", device_status, type_hist)
                     logged_waiting = True
 
-                if (now - last_status_publish_ts) >= status_publish_every_s:
+                if (now - last_status_publish_ts) >= run.status_publish_every_s:
                     mqttc.publish(status_topic, json_dumps({
-                        "ts": int(now),
+                        "ts": wall,
                         "status": "waiting_for_realtime_data" if now < first_data_deadline else "realtime_data_timeout",
                         "device_status": device_status,
                         "buf_types": type_hist,
-                    }), retain=False)
+                    }), qos=0, retain=False)
                     last_status_publish_ts = now
 
                 last_seen_age_s = None if last_seen_ts is None else max(0.0, now - last_seen_ts)
-                mqttc.publish(state_topic, json_dumps({
-                    "ts": int(now),
+                state = {
+                    "ts": wall,
                     "device_status": device_status,
-                    "last_seen_ts": None if last_seen_ts is None else int(last_seen_ts),
+                    "last_seen_ts": last_seen_wall,
                     "last_seen_age_s": last_seen_age_s,
                     "mqtt_connected": bool(mqtt_state.get("connected", False)),
-                    "device_mode": device_mode,
                     "last_error": last_error,
                     "temperature_c": cached_temperature_c,
                     "battery_pct": cached_battery_pct,
                     "spectrum_duration_s": cached_spectrum_duration_s,
                     "dose_total": cached_dose_total,
                     "rare_last_seen_age_s": None if cached_rare_seen_ts is None else max(0.0, now - cached_rare_seen_ts),
-                }), qos=0, retain=False)
-
-                time.sleep(poll_s)
+                }
+                stable = stable_fields(state)
+                if stable != last_state_stable or (now - last_state_publish_ts) >= state_refresh_s:
+                    mqttc.publish(state_topic, json_splice(state_prefix, state), qos=0, retain=False)
+                    if state_pack is not None:
+                        mqttc.publish(state_bin_topic, state_pack({**state_static, **state}), qos=0, retain=False)
+                    last_state_stable = stable
+                    last_state_publish_ts = now
+
+                mqtt_sleep(mqttc, mqtt_state, log, run.poll_s)
                 continue
 
             # Realtime OK
             last_seen_ts = now
+            last_seen_wall = wall
+            ble_stall_probes = 0
             if logged_waiting:
                 log.info("Realtime stream resumed")
                 logged_waiting = False
@@ -645,13 +1144,15 @@ def main() -> None:
 
             if rare is not None:
                 try:
-                    cached_temperature_c = getattr(rare, "temperature", cached_temperature_c)
-                    cached_battery_pct = getattr(rare, "charge_level", cached_battery_pct)
-                    cached_spectrum_duration_s = getattr(rare, "duration", cached_spectrum_duration_s)
-                    raw_dose_total = getattr(rare, "dose", None)
+                    temperature, charge_level, duration, raw_dose_total = _RARE_GET(rare)
+                    if temperature is not None:
+                        cached_temperature_c = temperature
+                    if charge_level is not None:
+                        cached_battery_pct = charge_level
+                    if duration is not None:
+                        cached_spectrum_duration_s = duration
                     if raw_dose_total is not None:
-                        _, dose_factor = get_dose_unit_and_factor(opts)
-                        cached_dose_total = raw_dose_total * dose_factor
+                        cached_dose_total = raw_dose_total * run.dose_factor
                     cached_rare_seen_ts = now
                 except Exception as e:
                     log.debug("RareData cache failed: %s", e)
@@ -663,16 +1164,14 @@ def main() -> None:
             flags = getattr(rt, "flags", None)
             real_time_flags = getattr(rt, "real_time_flags", None)
 
-            _, rate_factor = get_rate_unit_and_factor(opts)
-            dose_rate = (raw_dose_rate * rate_factor) if raw_dose_rate is not None else None
+            dose_rate = (raw_dose_rate * run.rate_factor) if raw_dose_rate is not None else None
 
-            mqttc.publish(state_topic, json_dumps({
-                "ts": int(now),
+            state = {
+                "ts": wall,
                 "device_status": device_status,
-                "last_seen_ts": int(last_seen_ts),
+                "last_seen_ts": last_seen_wall,
                 "last_seen_age_s": 0.0,
                 "mqtt_connected": bool(mqtt_state.get("connected", False)),
-                "device_mode": device_mode,
 
                 "dose_rate": dose_rate,
                 "cps": cps,
@@ -685,15 +1184,20 @@ def main() -> None:
                 "battery_pct": cached_battery_pct,
                 "spectrum_duration_s": cached_spectrum_duration_s,
                 "dose_total": cached_dose_total,
-                "dose_total_unit": get_dose_unit_and_factor(opts)[0],
                 "rare_last_seen_age_s": None if cached_rare_seen_ts is None else max(0.0, now - cached_rare_seen_ts),
 
                 "raw": {"dose_rate": raw_dose_rate, "count_rate": cps},
-            }), qos=0, retain=False)
-
-            if debug:
-                mqttc.publish(raw_fields_topic, json_dumps({
-                    "ts": int(now),
+            }
+            mqttc.publish(state_topic, json_splice(state_prefix, state), qos=0, retain=False)
+            if state_pack is not None:
+                mqttc.publish(state_bin_topic, state_pack({**state_static, **state}), qos=0, retain=False)
+            # A later "waiting" payload must not be skipped against a pre-ok one
+            last_state_stable = None
+            last_state_publish_ts = now
+
+            if run.debug:
+                raw_fields = {
+                    "ts": wall,
                     "buf_types": type_hist,
                     "realtime_fields": {
                         "count_rate": cps,
@@ -710,11 +1214,16 @@ def main() -> None:
                         "charge_level": getattr(rare, "charge_level", None),
                         "flags": getattr(rare, "flags", None),
                     },
-                }), retain=True)
-
-            if (now - last_status_publish_ts) >= status_publish_every_s:
-                log.info("OK: mode=%s cps=%s dose_rate=%s %s", device_mode, cps, dose_rate, get_rate_unit_and_factor(opts)[0])
-                mqttc.publish(status_topic, "ok", retain=False)
+                }
+                raw_stable = stable_fields(raw_fields, frozenset({"ts"}))
+                if raw_stable != last_raw_stable or (now - last_raw_publish_ts) >= state_refresh_s:
+                    mqttc.publish(raw_fields_topic, json_dumps(raw_fields), qos=0, retain=True)
+                    last_raw_stable = raw_stable
+                    last_raw_publish_ts = now
+
+            if (now - last_status_publish_ts) >= run.status_publish_every_s:
+                log.info("OK: mode=%s cps=%s dose_rate=%s %s", device_mode, cps, dose_rate, run.rate_unit)
+                mqttc.publish(status_topic, "ok", qos=0, retain=False)
                 last_status_publish_ts = now
 
         except SystemExit:
@@ -722,16 +1231,24 @@ def main() -> None:
         except Exception as e:
             device_status = "error"
             last_error = str(e)
-            log.error("Unhandled error in main loop: %s", e, exc_info=True)
-            mqttc.publish(status_topic, json_dumps({
-                "ts": int(time.time()),
-                "status": "error",
-                "error": str(e),
-                "traceback_tail": traceback.format_exc().splitlines()[-12:],
-            }), retain=False)
-            time.sleep(2)
-
-        time.sleep(poll_s)
+            err_now = time.monotonic()
+            err_key = (type(e).__name__, last_error)
+            err_status: dict[str, Any] = {"ts": int(time.time()), "status": "error", "error": last_error}
+            # Flapping links repeat the same error; only format the traceback once per window
+            if err_key != last_err_key or (err_now - last_err_fmt_ts) >= ERROR_TRACEBACK_WINDOW_S:
+                log.exception("Unhandled error in main loop: %s", e)
+                err_status["traceback_tail"] = traceback.format_exc().splitlines()[-12:]
+                last_err_key = err_key
+                last_err_fmt_ts = err_now
+                last_err_repeats = 0
+            else:
+                last_err_repeats += 1
+                log.error("Unhandled error in main loop (repeat %s): %s", last_err_repeats, e)
+                err_status["repeat"] = last_err_repeats
+            mqttc.publish(status_topic, json_dumps(err_status), qos=0, retain=False)
+            mqtt_sleep(mqttc, mqtt_state, log, 2)
+
+        mqtt_sleep(mqttc, mqtt_state, log, run.poll_s)
 
 
 if __name__ == "__main__":